@@ -9,28 +9,42 @@ installation.
 """
 
 import argparse
+import asyncio
+import collections
+import contextvars
+import errno
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import os
-import re
 from pathlib import Path
 import subprocess
-from typing import Sequence
+from typing import Iterable, Sequence
 
 __version__ = "0.1.1"
-default_ignore = [
-    ".git",
-    ".idea",
-    ".local",
-    ".pdm-build",
-    ".pex",
-    ".pyenv",
-    ".pytest_cache",
-    ".ruff_cache",
-    ".rye",
-    ".tox",
-    "__pycache__",
-    "dist",
-    "pipx",
-]
+default_ignore = frozenset(
+    {
+        ".git",
+        ".idea",
+        ".local",
+        ".pdm-build",
+        ".pex",
+        ".pyenv",
+        ".pytest_cache",
+        ".ruff_cache",
+        ".rye",
+        ".tox",
+        "__pycache__",
+        "dist",
+        "pipx",
+    }
+)
+
+
+def positive_int(value: str):
+    """Parse a command-line value that must be a positive integer."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 
 def process_args(args):
@@ -48,9 +62,9 @@ def process_args(args):
     argparser.add_argument(
         "--ignore",
         "-i",
-        help="Ignore the specified directories (default: %(default)s).",
+        help=f"Ignore the specified directories (default: {', '.join(sorted(default_ignore))}).",
         action="append",
-        default=default_ignore,
+        default=[],
     )
     argparser.add_argument(
         "--debug",
@@ -58,6 +72,20 @@ def process_args(args):
         help="Enable debug mode, prints out stderr of commands run.",
         action="store_true",
     )
+    argparser.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of directories to scan concurrently (default: %(default)s).",
+        type=positive_int,
+        default=min(32, (os.cpu_count() or 1) * 4),
+    )
+    argparser.add_argument(
+        "--rebuild-jobs",
+        "-J",
+        help="Virtual environments to rebuild at once (default: %(default)s).",
+        type=positive_int,
+        default=4,
+    )
     argparser.add_argument(
         "--dry-run", "-n", help="Do not make any changes.", action="store_true"
     )
@@ -75,124 +103,233 @@ def process_args(args):
     return argparser.parse_args(args)
 
 
-def find_virtual_environments(
-    directories: Sequence[Path], ignore: Sequence[str] = [], verbose: int = 0
-):
-    """Find all virtual environments in the directory recursively.
+def read_python_link(link: str):
+    """Read a virtual environment's python symlink.
 
-    Return as generator.
+    Relative hops such as python -> python3 are followed with readlink until
+    the first absolute target, which has the python/<version>/ segment we
+    want, so the rest of the chain is never resolved.  Raises OSError unless
+    the link exists and is a symlink, so no lstat is needed first.
+    """
+    target = os.readlink(link)
+    for _ in range(40):  # the same hop limit as the kernel's ELOOP check
+        if os.path.isabs(target):
+            return target
+        link = os.path.join(os.path.dirname(link), target)
+        try:
+            target = os.readlink(link)
+        except OSError:
+            # not a symlink, so this is the interpreter itself
+            return os.path.normpath(link)
+    raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), link)
+
+
+def scan_directory(top: str, ignore: frozenset[str], verbose: int = 0):
+    """Scan a single directory for a virtual environment or subdirectories.
+
+    Returns a tuple of (virtual environments found, subdirectories to search).
     """
-    while directories:
-        top = directories.pop()
-        for p in top.iterdir():
+    subdirectories = []
+    is_virtual_environment = False
+    with os.scandir(top) as it:
+        for entry in it:
             if verbose > 2:
-                print(f"Checking {p}")
-            if p.is_dir():
-                if p.name in ignore:
+                print(f"Checking {entry.path}")
+            # don't follow symlinked directories
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in ignore:
                     continue
-                if not p.is_symlink():  # don't follow symlinked directories
-                    directories.append(p)
-            elif p.name == "python" and p.is_symlink() and p.parent.name == "bin":
-                yield p.parent.parent, p.resolve()
+                subdirectories.append(entry.path)
+            elif entry.name == "pyvenv.cfg":
+                is_virtual_environment = True
+    # Every virtual environment has a pyvenv.cfg at its top level, which also
+    # rules out look-alikes such as conda environments.  A virtual environment
+    # can't contain another one we care about, so don't descend into it.
+    if is_virtual_environment:
+        try:
+            python = read_python_link(os.path.join(top, "bin", "python"))
+        except OSError:
+            return [], []
+        return [(Path(top), python)], []
+    return [], subdirectories
 
 
-python_version_pattern = re.compile(r"^\d+\.\d+(\.\d+)?$")
+def find_virtual_environments(
+    directories: Sequence[str],
+    ignore: Iterable[str] | None = None,
+    verbose: int = 0,
+    jobs: int = 1,
+):
+    """Find all virtual environments in the directory recursively.
+
+    Directories are scanned concurrently by up to `jobs` threads.
+
+    Return as generator.
+    """
+    ignore = frozenset(ignore or ())
+    # Directories waiting to be scanned stay plain strings on a stack that is
+    # popped depth first, and only a couple of scans per thread are in flight,
+    # so a wide tree doesn't turn its whole frontier into queued futures.
+    directories = list(directories)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while directories or pending:
+            while directories and len(pending) < jobs * 2:
+                pending.add(
+                    executor.submit(
+                        scan_directory, directories.pop(), ignore, verbose
+                    )
+                )
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                virtual_environments, subdirectories = future.result()
+                yield from virtual_environments
+                directories.extend(subdirectories)
 
 
 def is_a_version(part: str):
     """Check if a part of a path is a version number."""
-    # compare part to a regex matching a version number
-    if python_version_pattern.match(part):
-        return True
+    # matches "major.minor" or "major.minor.micro" with all-digit components
+    parts = part.split(".")
+    return 2 <= len(parts) <= 3 and all(p.isdigit() for p in parts)
+
+
+def extract_python_version(symlink: str):
+    """Extract the Python version from the python symlink target."""
+    parts = symlink.split(os.sep)
+    for part, next_part in zip(parts, parts[1:]):
+        if part == "python" and is_a_version(next_part):
+            return next_part
+
+
+def search_for_requirements(directory: str):
+    """Find a requirements file in the directory or its docker subdirectory."""
+    # First look at files in the directory.
+    # This check is pretty generic and will work for many projects in the wild.
+    requirements_file = os.path.join(directory, "requirements.txt")
+    if os.path.isfile(requirements_file):
+        return Path(requirements_file)
+    # The following checks are more specific to my use case.
+    # Then look to see if there is a requirements file in a docker directory.
+    requirements_file = os.path.join(directory, "docker", "requirements.txt")
+    if os.path.isfile(requirements_file):
+        return Path(requirements_file)
+    return None
 
 
-def extract_python_version(symlink: Path):
-    """Extract the Python version from the python symlink."""
-    for i, part in enumerate(symlink.parts):
-        if part == "python" and is_a_version(symlink.parts[i + 1]):
-            return symlink.parts[i + 1]
+# The following checks are more specific to my use case.
+# Projects in the administrator and eng-tools branches mirror each other, so
+# look in the corresponding project of the other branch.
+sibling_branches = {"administrator": "eng-tools", "eng-tools": "administrator"}
 
 
 def find_requirements_file(directory: Path):
     """Find the requirements file in the directory."""
-
-    def search_in(directory: Path):
-        # Quick sanity check to make sure directory exists and is a directory.
-        if not directory.is_dir():
-            return None
-
-        # First look at files in the directory.
-        # This check is pretty generic and will work for many projects in the wild.
-        found_docker_directory = False
-        for p in directory.iterdir():
-            if p.name == "requirements.txt":
-                return p
-            elif p.name == "docker":
-                found_docker_directory = True
-        # The following checks are more specific to my use case.
-        # Then look to see if there is a requirements file in a docker directory.
-        if found_docker_directory and (p := search_in(directory / "docker")):
-            return p
-
-    if p := search_in(directory):
+    if p := search_for_requirements(str(directory)):
         return p
-    # The following checks are more specific to my use case.
-    # if we're in the administrator branch, look for the corresponding eng-tools project.
-    if directory.parent.name == "administrator":
-        if p := search_in(directory.parent.with_name("eng-tools") / directory.name):
-            return p
-    # if we're in the eng-tools branch, look for the corresponding administrator project.
-    if directory.parent.name == "eng-tools":
-        if p := search_in(directory.parent.with_name("administrator") / directory.name):
-            return p
+    if sibling := sibling_branches.get(directory.parent.name):
+        return search_for_requirements(
+            str(directory.parent.with_name(sibling) / directory.name)
+        )
     return None
 
 
-def change_dir(path: Path, dry_run: bool, verbose: int = 0):
-    """Change to the specified directory."""
-    if dry_run:
-        print(f"Would change to {path}")
+# Messages for the virtual environment being fixed in the current task, so
+# concurrent fixes print their output in one piece instead of interleaved.
+fix_output: contextvars.ContextVar[list[str] | None] = contextvars.ContextVar(
+    "fix_output", default=None
+)
+
+
+def report(message: str):
+    """Print a message, or hold it until the current fix is done."""
+    messages = fix_output.get()
+    if messages is None:
+        print(message)
     else:
-        if verbose > 1:
-            print(f"Changing to {path}")
-        os.chdir(path)
+        messages.append(message)
 
 
-def run_command(cmd, dry_run, verbose, debug):
+async def run_command(cmd, dry_run, verbose, debug, cwd: Path | None = None):
     """Optionally run a command and optionally print the output based on flags and result.
 
+    The command is run in `cwd` when given, leaving the process's own working
+    directory alone so commands for several virtual environments can overlap.
+
     Returns the stdout of the command if it was successful, otherwise None."""
+    where = f" in {cwd}" if cwd else ""
     if not dry_run:
         if debug or verbose > 2:
-            print(f"Running: {cmd}")
-        result = subprocess.run(cmd, capture_output=True)
-        if debug or result.returncode != 0 or verbose > 2:
-            print(f"stdout: {result.stdout.decode()}")
-            print(f"stderr: {result.stderr.decode()}")
-            print(f"return code: {result.returncode}")
-        if result.returncode != 0:
+            report(f"Running: {cmd}{where}")
+        process = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if debug or process.returncode != 0 or verbose > 2:
+            report(f"command: {cmd}{where}")
+            report(f"stdout: {stdout.decode()}")
+            report(f"stderr: {stderr.decode()}")
+            report(f"return code: {process.returncode}")
+        if process.returncode != 0:
             return None
     else:
-        print(f"Would run: {cmd}")
+        report(f"Would run: {cmd}{where}")
         return "/tmp"
-    return result.stdout.decode().strip() or "OK"
+    # Strip the raw bytes first so empty output is never decoded.
+    output = stdout.strip()
+    return output.decode() if output else "OK"
 
 
-def fix_virtual_environment(
-    virtual_environment: Path,
-    symlink: Path,
+def mise_data_dir():
+    """Return the directory mise installs tools into."""
+    if data_dir := os.environ.get("MISE_DATA_DIR"):
+        return data_dir
+    xdg_data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser(
+        "~/.local/share"
+    )
+    return os.path.join(xdg_data_home, "mise")
+
+
+def find_python_in(prefix: str):
+    """Return the python executable installed under prefix, if there is one."""
+    for name in ("python", "python3"):
+        python = os.path.join(prefix, "bin", name)
+        if os.path.exists(python):
+            return python
+    return None
+
+
+async def find_target_python(
     target: str,
+    python_version: str,
     dry_run: bool,
     verbose: int = 0,
     debug: bool = False,
 ):
-    """Fix the virtual environment to use the new manager."""
-    print("--------------------")
-    python_version = extract_python_version(symlink)
-    # execute target manager to get the path to the python executable
-    # mise exec python@3.10.7 -- python -c 'import sys; print(sys.executable)'
+    """Find the path to the target manager's python executable for a version."""
     if target == "mise":
-        target_path = run_command(
+        if not python_version:
+            # there's no version to ask mise for, so every command would fail
+            return None
+        # Look in mise's install directory first, it is laid out as
+        # installs/python/<version>/bin/python.
+        if python := find_python_in(
+            os.path.join(mise_data_dir(), "installs", "python", python_version)
+        ):
+            return python
+        # ask mise for the install prefix instead of starting python to
+        # print sys.executable: mise where python@3.10.7
+        prefix = await run_command(
+            ["mise", "where", f"python@{python_version}"], dry_run, verbose, debug
+        )
+        if prefix and dry_run:
+            return os.path.join(prefix, "bin", "python")
+        if prefix and (python := find_python_in(prefix)):
+            return python
+        # Fall back to mise exec, which installs a missing version first.
+        # mise where fails for those, and an incomplete install has no python:
+        # mise exec python@3.10.7 -- python -c 'import sys; print(sys.executable)'
+        return await run_command(
             [
                 "mise",
                 "exec",
@@ -206,46 +343,68 @@ def fix_virtual_environment(
             verbose,
             debug,
         )
-        if dry_run:
-            # Fake target_path for dry_run so we can get reasonable results
-            if "mise/installs/python" in str(symlink):
-                target_path = str(symlink)
-            else:
-                target_path = f"/blah/mise/installs/python/{python_version}/bin/python"
-    elif target == "pyenv":
-        target_path = None
-    elif target == "rtx":
-        target_path = None
+    return None
 
-    if verbose > 0:
-        print(f"Found {symlink} in {virtual_environment} for version {python_version}.")
-        print(f"Target path: {target_path}")
 
-    if not target_path:
-        print(
-            f"Could not find a path to the {target} python executable for version {python_version}."
+async def fix_virtual_environment(
+    virtual_environment: Path,
+    symlink: str,
+    target: str,
+    dry_run: bool,
+    verbose: int = 0,
+    debug: bool = False,
+    target_pythons: dict[str | None, asyncio.Task] | None = None,
+):
+    """Fix the virtual environment to use the new manager.
+
+    `target_pythons` shares target python lookups, keyed by python version,
+    between virtual environments fixed in the same run.
+    """
+    report("--------------------")
+    python_version = extract_python_version(symlink)
+    if target_pythons is None:
+        target_pythons = {}
+    if python_version not in target_pythons:
+        target_pythons[python_version] = asyncio.ensure_future(
+            find_target_python(target, python_version, dry_run, verbose, debug)
         )
-        return
+    target_path = await target_pythons[python_version]
+    if target == "mise" and dry_run:
+        # Fake target_path for dry_run so we can get reasonable results
+        if "mise/installs/python" in symlink:
+            target_path = symlink
+        else:
+            target_path = f"/blah/mise/installs/python/{python_version}/bin/python"
+
+    if verbose > 0:
+        report(
+            f"Found {symlink} in {virtual_environment} for version {python_version}."
+        )
+        report(f"Target path: {target_path}")
 
     if not target_path:
-        print(
+        report(
             f"Could not find a path to the {target} python executable for version {python_version}."
         )
         return
     if verbose > 0:
-        print(f"Fixing {virtual_environment} to use {target_path}...")
-    parent_files = list(p.name for p in virtual_environment.parent.iterdir())
+        report(f"Fixing {virtual_environment} to use {target_path}...")
+    parent_files = {entry.name for entry in os.scandir(virtual_environment.parent)}
 
     reinstall_packages = False
-    if Path(target_path).exists() and symlink.samefile(target_path):
-        print(f"Skipping {virtual_environment}, it is already using {target}.")
+    if (
+        os.path.exists(target_path)
+        and os.path.exists(symlink)
+        and os.path.samefile(symlink, target_path)
+    ):
+        report(f"Skipping {virtual_environment}, it is already using {target}.")
     elif target == "mise":
-        print(f"Attempting to use mise to rebuild {virtual_environment}.")
-        if not run_command(
+        report(f"Attempting to use mise to rebuild {virtual_environment}.")
+        if not await run_command(
             ["rm", "-rf", str(virtual_environment)], dry_run, verbose, debug
         ):
             return
-        if not run_command(
+        if not await run_command(
             [
                 "mise",
                 "exec",
@@ -263,56 +422,143 @@ def fix_virtual_environment(
             return
         reinstall_packages = True
     elif target == "rtx":
-        print("No support for RTX yet because my use case is moving to mise.")
+        report("No support for RTX yet because my use case is moving to mise.")
         return
     elif target == "pyenv":
-        print("No support for pyenv yet because my use case is moving to mise.")
+        report("No support for pyenv yet because my use case is moving to mise.")
         return
 
     if reinstall_packages:
         if "pdm.lock" in parent_files:
-            print(
+            report(
                 f"Found pdm.lock in {virtual_environment.parent} using pdm to restore packages."
             )
-            change_dir(virtual_environment.parent, dry_run, verbose)
-            if not run_command(["pdm", "install"], dry_run, verbose, debug):
+            if not await run_command(
+                ["pdm", "install"],
+                dry_run,
+                verbose,
+                debug,
+                cwd=virtual_environment.parent,
+            ):
                 return
         elif requirements_file := find_requirements_file(virtual_environment.parent):
-            print(f"Found {requirements_file} using pip to restore packages.")
-            change_dir(virtual_environment.parent, dry_run, verbose)
-            if not run_command(
+            report(f"Found {requirements_file} using pip to restore packages.")
+            if not await run_command(
                 ["pip", "install", "-r", str(requirements_file)],
                 dry_run,
                 verbose,
                 debug,
+                cwd=virtual_environment.parent,
             ):
                 return
         else:
-            print(f"I don't know how to restore packages in {virtual_environment}.")
+            report(f"I don't know how to restore packages in {virtual_environment}.")
 
     if ".rtx.toml" in parent_files and target == "mise":
-        print(
+        report(
             f"Found .rtx.toml in {virtual_environment.parent}, renaming to .mise.toml"
         )
-        change_dir(virtual_environment.parent, dry_run, verbose)
-        if not run_command(["mv", ".rtx.toml", ".mise.toml"], dry_run, verbose, debug):
+        if not await run_command(
+            ["mv", ".rtx.toml", ".mise.toml"],
+            dry_run,
+            verbose,
+            debug,
+            cwd=virtual_environment.parent,
+        ):
             return
 
 
+async def fix_virtual_environments(
+    virtual_environments: Sequence[tuple[Path, str]],
+    target: str,
+    dry_run: bool,
+    jobs: int = 1,
+    verbose: int = 0,
+    debug: bool = False,
+):
+    """Fix the virtual environments, up to `jobs` of them at a time.
+
+    Dry runs fix one at a time so the output stays in a readable order.
+    """
+    target_pythons = {}
+    if dry_run:
+        for virtual_environment, symlink in virtual_environments:
+            await fix_virtual_environment(
+                virtual_environment,
+                symlink,
+                target,
+                dry_run,
+                verbose,
+                debug,
+                target_pythons,
+            )
+        return
+
+    semaphore = asyncio.Semaphore(jobs)
+    # Virtual environments in the same project share its pdm.lock and
+    # .rtx.toml, so fix those one after another.
+    parent_locks = collections.defaultdict(asyncio.Lock)
+
+    async def fix(virtual_environment: Path, symlink: str):
+        async with parent_locks[virtual_environment.parent], semaphore:
+            messages = []
+            fix_output.set(messages)
+            try:
+                await fix_virtual_environment(
+                    virtual_environment,
+                    symlink,
+                    target,
+                    dry_run,
+                    verbose,
+                    debug,
+                    target_pythons,
+                )
+            finally:
+                print("\n".join(messages))
+
+    results = await asyncio.gather(
+        *(
+            fix(virtual_environment, symlink)
+            for virtual_environment, symlink in virtual_environments
+        ),
+        return_exceptions=True,
+    )
+    # Let every rebuild finish before reporting failures, cancelling the
+    # others part way through would leave them half rebuilt.
+    failures = []
+    for (virtual_environment, _), result in zip(virtual_environments, results):
+        if isinstance(result, BaseException):
+            result.add_note(f"while fixing {virtual_environment}")
+            failures.append(result)
+    if failures:
+        raise BaseExceptionGroup(
+            f"failed to fix {len(failures)} virtual environment(s)", failures
+        )
+
+
 def main(args=None):
     """The main entry point for the command-line interface."""
     args = process_args(args)
-    for virtual_environment, symlink in find_virtual_environments(
-        list(d.resolve() for d in args.directories), args.ignore, args.verbose
-    ):
-        fix_virtual_environment(
-            virtual_environment,
-            symlink,
+    # Scans finish in whatever order the threads get to them, sort so the
+    # virtual environments are always fixed in the same order.
+    virtual_environments = sorted(
+        find_virtual_environments(
+            list(os.path.abspath(d) for d in args.directories),
+            default_ignore.union(args.ignore),
+            args.verbose,
+            args.jobs,
+        )
+    )
+    asyncio.run(
+        fix_virtual_environments(
+            virtual_environments,
             args.target,
             args.dry_run,
+            args.rebuild_jobs,
             args.verbose,
             args.debug,
         )
+    )
 
 
 if __name__ == "__main__":
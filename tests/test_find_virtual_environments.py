@@ -0,0 +1,115 @@
+import argparse
+
+import pytest
+
+from pyvenvfixer import (
+    default_ignore,
+    find_virtual_environments,
+    main,
+    positive_int,
+    process_args,
+)
+
+PYTHON = "/opt/mise/installs/python/3.12.1/bin/python3.12"
+
+
+def make_venv(path, target=PYTHON):
+    """Create a minimal virtual environment whose bin/python links to target."""
+    (path / "bin").mkdir(parents=True)
+    (path / "lib" / "python3.12" / "site-packages").mkdir(parents=True)
+    (path / "pyvenv.cfg").write_text("home = /opt\n")
+    (path / "bin" / "python").symlink_to(target)
+    return path
+
+
+def found(tmp_path, ignore=default_ignore, jobs=4):
+    virtual_environments = find_virtual_environments([str(tmp_path)], ignore, jobs=jobs)
+    return sorted((str(venv), target) for venv, target in virtual_environments)
+
+
+def test_detects_virtual_environment_by_pyvenv_cfg(tmp_path):
+    venv = make_venv(tmp_path / "project" / ".venv")
+    # looks like a venv but has no pyvenv.cfg, e.g. a conda environment
+    conda = tmp_path / "conda"
+    (conda / "bin").mkdir(parents=True)
+    (conda / "bin" / "python").symlink_to(PYTHON)
+
+    assert found(tmp_path) == [(str(venv), PYTHON)]
+
+
+def test_does_not_descend_into_virtual_environment(tmp_path):
+    venv = make_venv(tmp_path / "project" / ".venv")
+    make_venv(venv / "lib" / "python3.12" / "site-packages" / "nested")
+
+    assert found(tmp_path) == [(str(venv), PYTHON)]
+
+
+def test_skips_ignored_directories(tmp_path):
+    venv = make_venv(tmp_path / "project" / ".venv")
+    make_venv(tmp_path / "project" / ".tox" / "py312")
+    make_venv(tmp_path / "other" / ".venv")
+
+    assert found(tmp_path, default_ignore | {"other"}) == [(str(venv), PYTHON)]
+
+
+def test_does_not_follow_symlinked_directories(tmp_path):
+    venv = make_venv(tmp_path / "project" / ".venv")
+    (tmp_path / "link").symlink_to(tmp_path / "project")
+    # a symlink cycle must not be walked either
+    (tmp_path / "project" / "loop").symlink_to(tmp_path)
+
+    assert found(tmp_path) == [(str(venv), PYTHON)]
+
+
+def test_resolves_relative_python_link(tmp_path):
+    venv = make_venv(tmp_path / ".venv", "python3")
+    (venv / "bin" / "python3").symlink_to(PYTHON)
+
+    assert found(tmp_path) == [(str(venv), PYTHON)]
+
+
+def test_keeps_first_absolute_target_of_relative_python_link(tmp_path):
+    # the install's own python3.12 is a link too, it must not be resolved
+    install = tmp_path / "mise" / "installs" / "python" / "3.12.1" / "bin"
+    install.mkdir(parents=True)
+    (install / "python3.12").symlink_to(tmp_path / "elsewhere" / "python")
+    venv = make_venv(tmp_path / "project" / ".venv", "python3")
+    (venv / "bin" / "python3").symlink_to(install / "python3.12")
+
+    assert found(tmp_path / "project") == [(str(venv), str(install / "python3.12"))]
+
+
+def test_skips_python_link_cycle(tmp_path):
+    venv = make_venv(tmp_path / ".venv", "python3")
+    (venv / "bin" / "python3").symlink_to("python")
+
+    assert found(tmp_path) == []
+
+
+def test_main_fixes_virtual_environments_in_sorted_order(tmp_path, capsys):
+    names = [f"project{i:02}" for i in range(20)]
+    for name in reversed(names):
+        make_venv(tmp_path / name / ".venv")
+
+    main(["--dry-run", "--jobs", "8", str(tmp_path)])
+
+    removed = [
+        line
+        for line in capsys.readouterr().out.splitlines()
+        if line.startswith("Would run: ['rm'")
+    ]
+    assert removed == [
+        f"Would run: ['rm', '-rf', '{tmp_path / name / '.venv'}']" for name in names
+    ]
+
+
+@pytest.mark.parametrize("value", ["0", "-1"])
+def test_positive_int_rejects_values_below_one(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        positive_int(value)
+
+
+def test_jobs_option_rejects_zero(capsys):
+    with pytest.raises(SystemExit):
+        process_args(["--jobs", "0"])
+    assert "must be at least 1" in capsys.readouterr().err
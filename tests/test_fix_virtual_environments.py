@@ -0,0 +1,125 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+
+from pyvenvfixer import find_target_python, fix_virtual_environments
+
+PYTHON = "/opt/pyenv/versions/python/3.12.1/bin/python3.12"
+
+
+@pytest.fixture
+def stubs(tmp_path, monkeypatch):
+    """Put stub mise, pdm and pip commands that log their calls on PATH."""
+    bin_dir = tmp_path / "stubs"
+    bin_dir.mkdir()
+    log = tmp_path / "commands.log"
+    prefix = tmp_path / "mise-python"
+    (prefix / "bin").mkdir(parents=True)
+    (prefix / "bin" / "python").touch()
+    scripts = {
+        "mise": f'echo "mise $*" >> {log}\n[ "$1" = where ] && echo {prefix}\nexit 0',
+        "pdm": "\n".join(
+            [
+                f'echo "pdm start $PWD" >> {log}',
+                "sleep 0.2",
+                f'echo "pdm end $PWD" >> {log}',
+            ]
+        ),
+        "pip": f'echo "pip $*" >> {log}',
+    }
+    for name, body in scripts.items():
+        stub = bin_dir / name
+        stub.write_text(f"#!/bin/sh\n{body}\n")
+        stub.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    # keep the mise install directory probe from finding anything real
+    monkeypatch.setenv("MISE_DATA_DIR", str(tmp_path / "no-mise"))
+    return bin_dir, log
+
+
+def make_venv(project, name=".venv"):
+    """Create a project with a virtual environment that still uses pyenv."""
+    venv = project / name
+    (venv / "bin").mkdir(parents=True)
+    (venv / "pyvenv.cfg").touch()
+    (venv / "bin" / "python").symlink_to(PYTHON)
+    return venv, PYTHON
+
+
+def commands(log):
+    return log.read_text().splitlines()
+
+
+def test_virtual_environments_in_one_project_are_fixed_one_at_a_time(
+    tmp_path, stubs
+):
+    _, log = stubs
+    project = tmp_path / "project"
+    venvs = [make_venv(project, ".venv"), make_venv(project, "venv2")]
+    (project / "pdm.lock").touch()
+    (project / ".rtx.toml").touch()
+
+    asyncio.run(fix_virtual_environments(venvs, "mise", False, jobs=4))
+
+    pdm_runs = [line for line in commands(log) if line.startswith("pdm")]
+    assert pdm_runs == [f"pdm start {project}", f"pdm end {project}"] * 2
+    assert (project / ".mise.toml").exists()
+    assert not (project / ".rtx.toml").exists()
+
+
+def test_target_python_is_looked_up_once_per_version(tmp_path, stubs):
+    _, log = stubs
+    venvs = [make_venv(tmp_path / f"project{i}") for i in range(3)]
+
+    asyncio.run(fix_virtual_environments(venvs, "mise", False, jobs=4))
+
+    assert commands(log).count("mise where python@3.12.1") == 1
+    assert sum(line.startswith("mise exec") for line in commands(log)) == 3
+
+
+def test_failures_are_collected_after_every_rebuild_finishes(
+    tmp_path, stubs, monkeypatch
+):
+    bin_dir, log = stubs
+    (bin_dir / "pdm").unlink()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}/usr/bin{os.pathsep}/bin")
+    if shutil.which("pdm"):
+        pytest.skip("a real pdm is installed")
+    failing = [make_venv(tmp_path / name) for name in ("a", "b")]
+    for venv, _ in failing:
+        (venv.parent / "pdm.lock").touch()
+    working = make_venv(tmp_path / "c")
+    (working[0].parent / "requirements.txt").touch()
+
+    with pytest.raises(BaseExceptionGroup) as excinfo:
+        asyncio.run(
+            fix_virtual_environments([*failing, working], "mise", False, jobs=4)
+        )
+
+    errors = excinfo.value.exceptions
+    assert [type(error) for error in errors] == [FileNotFoundError] * 2
+    assert [error.__notes__ for error in errors] == [
+        [f"while fixing {venv}"] for venv, _ in failing
+    ]
+    requirements = working[0].parent / "requirements.txt"
+    assert f"pip install -r {requirements}" in commands(log)
+
+
+def test_partial_mise_install_falls_back_to_mise_where(tmp_path, stubs, monkeypatch):
+    _, log = stubs
+    (tmp_path / "mise" / "installs" / "python" / "3.12.1").mkdir(parents=True)
+    monkeypatch.setenv("MISE_DATA_DIR", str(tmp_path / "mise"))
+
+    python = asyncio.run(find_target_python("mise", "3.12.1", False))
+
+    assert python == str(tmp_path / "mise-python" / "bin" / "python")
+    assert commands(log) == ["mise where python@3.12.1"]
+
+
+def test_unknown_python_version_runs_no_commands(tmp_path, stubs):
+    _, log = stubs
+
+    assert asyncio.run(find_target_python("mise", None, False)) is None
+    assert not log.exists()